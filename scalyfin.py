@@ -1,27 +1,43 @@
 #!/usr/bin/env python3
 
 import os
+import errno
 import re
 import tempfile
 import shutil
 import time
 import subprocess
 import threading
+import queue
+import heapq
+import collections
+import hashlib
+import glob
+import functools
 import logging
 import json
 import math
 import atexit
 import signal
+import ctypes
+import struct
+import fcntl
+import sqlite3
+import selectors
+import shlex
 
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
-
-from pysubparser import parser, writer
+from concurrent.futures import ThreadPoolExecutor
 
 # ====================== CONFIGURATION =======================
 WATCH_DIR = os.path.abspath(os.getenv("WATCH_DIR", "/watch_dir"))
 OUTPUT_DIR = os.path.abspath(os.getenv("OUTPUT_DIR", "/output_dir"))
-SCAN_INTERVAL = 60                 # Scan interval in seconds
+# Normalized roots with trailing separator for path prefix checks
+WATCH_PREFIX = os.path.join(WATCH_DIR, "")
+OUTPUT_PREFIX = os.path.join(OUTPUT_DIR, "")
+SCAN_INTERVAL = int(os.getenv("SCAN_INTERVAL", "60"))  # Scan interval in seconds
+# Toggle to only poll WATCH_DIR with periodic scans, for mounts
+# without inotify/fanotify support such as CIFS/SMB or FUSE (default: no)
+WATCH_POLL = os.getenv("WATCH_POLL", "no").lower() in ("true", "1", "yes")
 
 # Toggle for GPU acceleration backends: "amd" or "rockchip"
 GPU_ACCEL = os.getenv("GPU_ACCEL", "undef").lower()
@@ -46,28 +62,112 @@ MAX_BITRATES_MAP = {
 DELETE_ORIGINAL_FILE = os.getenv("DELETE_ORIGINAL_FILE", "yes").lower() in ("true", "1", "yes")
 # Toggle to skip/force transcoding if anything changed (default: yes)
 GET_BY_WITH_RENAMING = os.getenv("GET_BY_WITH_RENAMING", "yes").lower() in ("true", "1", "yes")
+# Toggle to convert ASS/SSA subtitles in a separate ffmpeg run instead of
+# the transcoding one, for ffmpeg builds failing to convert them inline (default: no)
+EXTRACT_SUBTITLES = os.getenv("EXTRACT_SUBTITLES", "no").lower() in ("true", "1", "yes")
+
+# Video file extensions picked up by directory scans
+VIDEO_EXTENSIONS = frozenset(
+    ext.strip().lower() for ext in
+    os.getenv("VIDEO_EXTENSIONS", ".mkv,.mp4,.m4v,.ts,.m2ts,.mts,.mov,.webm,.avi").split(","))
+# Files smaller than this (in bytes) are never probed as videos
+MIN_VIDEO_SIZE = int(os.getenv("MIN_VIDEO_SIZE", "50000000"))
+
+# ffprobe limits: read stream info from container headers only
+FFPROBE_CAPS = ("-probesize", "1000000", "-analyzeduration", "0")
+MPEG_TS_EXTENSIONS = frozenset({".ts", ".m2ts", ".mts"})
+
+# On-disk cache of ffprobe results
+PROBE_CACHE_FILE = os.getenv("PROBE_CACHE_FILE", "/tmp/scalyfin_probe.db")
+# Number of probes kept in memory, others are read from disk on demand
+PROBE_CACHE_SIZE = 4096
+# Bumped whenever the fields of cached probes change
+PROBE_CACHE_VERSION = 1
 
 # Stability checking
 STABILITY_CHECK_INTERVAL = 5       # seconds between file checks
 STABILITY_REQUIRED_ROUNDS = 4      # number of consecutive stable checks required
+# States of tracked files
+FILE_PENDING = 0      # waiting for stability checks
+FILE_QUEUED = 1       # stable, waiting for or going through processing
+FILE_PROCESSED = 2
+FILE_SKIPPABLE = 3    # not a video
+# Outcomes of a stability round
+ROUND_PENDING = 0     # not stable yet, checked again later
+ROUND_STABLE = 1
+ROUND_GONE = 2        # file disappeared
+# Maximum number of files waiting for stability checks
+MAX_PENDING_FILES = int(os.getenv("MAX_PENDING_FILES", "10000"))
+# Number of concurrent stability rounds of due files
+CHECK_WORKERS = 8
+# Number of concurrent probes of stable files
+PROBE_WORKERS = int(os.getenv("PROBE_WORKERS", "4"))
+
+# Transcoding jobs: worker threads and concurrent ffmpeg runs per backend
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "2"))
+GPU_CONCURRENCY = int(os.getenv("GPU_CONCURRENCY", "2"))
+CPU_CONCURRENCY = int(os.getenv("CPU_CONCURRENCY", "1"))
+# Software encoding: two-pass toggle (default: no)
+ENABLE_TWO_PASS = os.getenv("ENABLE_TWO_PASS", "no").lower() in ("true", "1", "yes")
+# ffmpeg thread limit (0: auto, worker CPU count for software encodes)
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "0"))
+# Hardware encodes only demux and feed the GPU, a few threads are plenty
+HARDWARE_FFMPEG_THREADS = 4
+FFMPEG_FILTER_THREADS = 2
+# Number of last ffmpeg stderr bytes kept for error reporting
+FFMPEG_STDERR_TAIL = 65536
+
+# inotify event masks (see linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+# IN_CREATE is only acted on for subdirectories; files are picked up
+# once written (IN_CLOSE_WRITE) or moved in (IN_MOVED_TO)
+INOTIFY_WATCH_MASK = (
+    IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_EXCL_UNLINK)
+# struct inotify_event header: wd, mask, cookie, len
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 65536
+# fanotify flags and event header (see linux/fanotify.h)
+FAN_CLOSE_WRITE = 0x00000008
+FAN_Q_OVERFLOW = 0x00004000
+FAN_CLASS_NOTIF = 0x00000000
+FAN_CLOEXEC = 0x00000001
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_MOUNT = 0x00000010
+FAN_NOFD = -1
+AT_FDCWD = -100
+# struct fanotify_event_metadata: event_len, vers, reserved, metadata_len,
+# mask, fd, pid
+FANOTIFY_EVENT = struct.Struct("=IBBHQii")
+FANOTIFY_READ_SIZE = 65536
+# Repeated events of a file within this interval (seconds) are dropped
+EVENT_COALESCE_INTERVAL = 1.0
+RECENT_EVENTS_TTL = 60
 
 # Logging configuration
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
 
-# Mappings
-SUBS_CODEC_TO_EXTENSION = {
-    'subrip': '.srt',
-    'ass': '.ass',
-    'ssa': '.ssa',
-    'microdvd': '.sub',
-    'subviewer': '.txt'}
+# Matches " - {Tag}" only at the end of a file base name
+FILE_TAG_PATTERN = re.compile(r" - [^()]+$")
 
 # Healthcheck configuration
 UPDATE_TIMER = 20
 UPDATE_FILE = "/tmp/scalyfin_status"
 TEMP_FILES = [UPDATE_FILE]
-terminate = False
+# Number of released temporary files kept for reuse per suffix
+TEMP_POOL_SIZE = 8
+# Hidden prefix of temporary videos, ignored by the watchers
+TEMP_VIDEO_PREFIX = ".scaler_"
+# Set on shutdown, checked by the main loop and transcoding workers
+terminate = threading.Event()
+# Seconds to wait for transcoding workers to stop on shutdown
+SHUTDOWN_TIMEOUT = 5
 # =================== END OF CONFIG ==========================
 
 
@@ -78,23 +178,37 @@ def setup_logging():
         logging.info(f"AMD VAAPI device: {AMD_VAAPI_DEVICE}")
     logging.info(f"Watching directory: {WATCH_DIR}")
     logging.info(f"Output directory: {OUTPUT_DIR}")
+    logging.info(f"Watch by polling only: {WATCH_POLL}")
     logging.info(f"Get by with renaming: {GET_BY_WITH_RENAMING}")
     logging.info(f"Delete original file: {DELETE_ORIGINAL_FILE}")
+    logging.info(f"Extract subtitles: {EXTRACT_SUBTITLES}")
 
 
 # Healthcheck handler
 def update_status():
-    """Periodically update the status file to indicate the script is running."""
-    global terminate
-    while not terminate:
+    """
+    Touch the status file to indicate the script is running,
+    the healthcheck only looks at its mtime.
+    """
+    try:
         try:
+            os.utime(UPDATE_FILE)
+        except FileNotFoundError:
             with open(UPDATE_FILE, "w") as f:
                 f.write("running")
-            time.sleep(UPDATE_TIMER)
-        except Exception as e:
-            logging.error(f"Error updating status file: {e}")
-            terminate = True
-            break
+    except Exception as e:
+        logging.error(f"Error updating status file: {e}")
+        terminate.set()
+
+
+def update_status_loop():
+    """
+    Thread function: updates the status file every UPDATE_TIMER seconds,
+    apart from the main loop whose tasks may block on slow mounts.
+    """
+    while not terminate.is_set():
+        update_status()
+        terminate.wait(UPDATE_TIMER)
 
 
 def cleanup_temp_files():
@@ -110,102 +224,312 @@ def cleanup_temp_files():
 
 
 def signal_handler(signum, frame):
-    """Set the terminate flag when a signal is received."""
-    global terminate
+    """
+    Set the terminate flag when a signal is received, and terminate
+    running ffmpeg process groups right away rather than once
+    the main loop returns.
+    """
     logging.info(f"Signal {signum} received.")
-    terminate = True
-
+    terminate.set()
+    with ffmpeg_processes_lock:
+        for process in ffmpeg_processes:
+            signal_ffmpeg(process, signal.SIGTERM)
 
-def update_files_map(files_map, path):
-    if path in files_map:
-        info = files_map[path]
-        size_last = info.size_history[-1]
-        size_now = os.path.getsize(path)
-        mod_time_now = os.path.getmtime(path)
-        if size_last != size_now or info.mod_time != mod_time_now:
-            files_map.pop(path, None)
 
-
-def is_new_file(path):
-    update_files_map(processed_files, path)
-    update_files_map(skippable_files, path)
-    return path not in pending_files and path not in processed_files and path not in skippable_files
+def is_new_file(path, entry=None):
+    """
+    A file is new unless it's tracked already.
+    Processed and skipped files become new again once they change.
+    Takes tracked_files_lock, the file is only stat'ed without it.
+    :param entry: os.DirEntry of the file from a scan, its stat is reused
+    """
+    with tracked_files_lock:
+        info = tracked_files.get(path)
+        if info is None:
+            return True
+        if info.state in (FILE_PENDING, FILE_QUEUED):
+            return False
+    stat = entry.stat() if entry is not None else os.stat(path)
+    if (info.last_size != stat.st_size
+            or info.mod_time != stat.st_mtime_ns):
+        with tracked_files_lock:
+            # Unless another thread replaced it meanwhile
+            if tracked_files.get(path) is info:
+                del tracked_files[path]
+        invalidate_probe(path)
+        return True
+    return False
 
 
-class NewcomersHandler(FileSystemEventHandler):
+def handle_file_event(path):
     """
-    Handles watchdog events: files created or modified.
-    If a video file is found, add/update it in the pending queue for processing.
+    Handles inotify events: files created, moved in or closed after writing.
+    If a new file is found, add/update it in the pending queue for processing.
     """
-    def on_created(self, event):
-        if not event.is_directory and is_new_file(event.src_path):
-            logging.info(
-                f"File system event found new file on create: "
-                f"{event.src_path}")
-            add_file_to_pending(event.src_path)
-
-    def on_modified(self, event):
-        if not event.is_directory and is_new_file(event.src_path):
-            logging.info(
-                f"File system event found new file on modify: "
-                f"{event.src_path}")
-            add_file_to_pending(event.src_path)
+    # Coalesce event storms of the same file
+    now = time.monotonic()
+    if now - recent_events.get(path, -math.inf) < EVENT_COALESCE_INTERVAL:
+        return
+    recent_events[path] = now
+    if has_video_extension(path) and is_new_file(path):
+        logging.info(f"File system event found new file: {path}")
+        add_file_to_pending(path)
+
+
+def prune_recent_events():
+    """Forget coalesced events older than RECENT_EVENTS_TTL."""
+    expired = time.monotonic() - RECENT_EVENTS_TTL
+    for path in [p for p, seen in list(recent_events.items()) if seen < expired]:
+        del recent_events[path]
+
+
+def inotify_init():
+    """Open an inotify instance, returns libc handle and inotify fd."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.inotify_add_watch.argtypes = [
+        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return libc, fd
+
+
+def add_watches(libc, fd, root, watches):
+    """Recursively add inotify watches for root and its subdirectories."""
+    for dir_path, _, _ in os.walk(root):
+        wd = libc.inotify_add_watch(
+            fd, os.fsencode(dir_path), INOTIFY_WATCH_MASK)
+        if wd < 0:
+            logging.warning(
+                f"Failed to watch {dir_path}: "
+                f"{os.strerror(ctypes.get_errno())}")
+            continue
+        watches[wd] = dir_path
+
+
+class DirectoryWatcher:
+    """
+    Watches a directory recursively via inotify.
+    Events are read from the inotify fd in bulk and dispatched per file.
+    Periodic scans cover anything inotify can't see (e.g. network mounts).
+    """
+    def __init__(self, root):
+        self.libc, self.fd = inotify_init()
+        self.watches = {}
+        add_watches(self.libc, self.fd, root, self.watches)
+
+    def fileno(self):
+        return self.fd
+
+    def read_events(self):
+        """Read and dispatch pending inotify events."""
+        buffer = os.read(self.fd, INOTIFY_READ_SIZE)
+        overflow = False
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, name_len = INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT.size
+            name = buffer[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("inotify queue overflow, events were lost")
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            dir_path = self.watches.get(wd)
+            if dir_path is None or not name:
+                continue
+            path = os.path.join(dir_path, os.fsdecode(name))
+            try:
+                if mask & IN_ISDIR:
+                    # Watch new subdirectory and pick up files
+                    # that landed before the watch was set
+                    add_watches(self.libc, self.fd, path, self.watches)
+                    for entry in walk_files(path):
+                        handle_file_event(entry.path)
+                elif mask & IN_CREATE:
+                    # Files still being written, wait for close or move
+                    continue
+                else:
+                    # fanotify only sees writes through its own mount,
+                    # not those of the host or other containers
+                    handle_file_event(path)
+            except OSError as e:
+                logging.debug(f"Error handling event for {path}: {e}")
+        if overflow:
+            # Lost events, catch up with a scan right away
+            scan_directory()
 
 
-def scan_directory():
-    """Periodically scan the directory for new files."""
+def fanotify_init():
+    """
+    Open a fanotify instance reporting FAN_CLOSE_WRITE
+    for the whole mount of WATCH_DIR, returns fanotify fd.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.fanotify_mark.argtypes = [
+        ctypes.c_int, ctypes.c_uint, ctypes.c_uint64,
+        ctypes.c_int, ctypes.c_char_p]
+    fd = libc.fanotify_init(FAN_CLASS_NOTIF | FAN_CLOEXEC,
+                            os.O_RDONLY | os.O_LARGEFILE | os.O_CLOEXEC)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    if libc.fanotify_mark(fd, FAN_MARK_ADD | FAN_MARK_MOUNT, FAN_CLOSE_WRITE,
+                          AT_FDCWD, os.fsencode(WATCH_DIR)) < 0:
+        err = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(err, os.strerror(err))
+    return fd
+
+
+def watch_closed_files():
+    """
+    Thread function: receives FAN_CLOSE_WRITE events via fanotify,
+    so files closed by their writer need a single stability round.
+    Needs CAP_SYS_ADMIN, without it stability polling covers all files.
+    """
+    try:
+        fd = fanotify_init()
+    except (OSError, AttributeError) as e:
+        logging.info(f"fanotify unavailable, relying on stability checks: {e}")
+        return
+    watch_prefix = os.path.join(os.path.realpath(WATCH_DIR), "")
     while True:
-        for root, _, files in os.walk(WATCH_DIR):
-            for file in files:
-                file_path = os.path.join(root, file)
-                if is_new_file(file_path):
-                    logging.info(f"Scanner found new file: {file_path}")
-                    add_file_to_pending(file_path)
-        time.sleep(SCAN_INTERVAL)
+        buffer = os.read(fd, FANOTIFY_READ_SIZE)
+        offset = 0
+        while offset + FANOTIFY_EVENT.size <= len(buffer):
+            event_len, _, _, _, mask, event_fd, _ = FANOTIFY_EVENT.unpack_from(
+                buffer, offset)
+            offset += max(event_len, FANOTIFY_EVENT.size)
+            if event_fd == FAN_NOFD:
+                if mask & FAN_Q_OVERFLOW:
+                    logging.warning("fanotify queue overflow, events were lost")
+                continue
+            try:
+                path = os.readlink(f"/proc/self/fd/{event_fd}")
+            except OSError:
+                continue
+            finally:
+                os.close(event_fd)
+            if not path.startswith(watch_prefix):
+                continue
+            # Report paths relative to WATCH_DIR as the rest of the script does
+            path = os.path.join(WATCH_DIR, path[len(watch_prefix):])
+            try:
+                handle_closed_file(path)
+            except OSError as e:
+                logging.debug(f"Error handling closed file {path}: {e}")
 
 
-def convert_subtitle(input_subs, output_subs):
+def handle_closed_file(path):
     """
-    Convert a subtitle file from one format to another.
-    :param input_subs: path of the input subtitle file
-    :param output_subs: path of the output subtitle file
+    Fast path for files closed after writing: the file goes to stability
+    checks with all but one round credited, so it's queued after a single
+    check interval without changes. Writers that reopen the file,
+    or still have it open, reset the rounds as usual.
     """
-    subtitles = parser.parse(input_subs)
-    writer.write(subtitles, output_subs)
-    logging.info(f"Converted {input_subs} to {output_subs}")
+    if not has_video_extension(path):
+        return
+    stat = os.stat(path)
+    with tracked_files_lock:
+        info = tracked_files.get(path)
+        tracked = info is not None and info.state == FILE_PENDING
+    if not tracked and not is_new_file(path):
+        return
+    if not tracked and not add_file_to_pending(path):
+        return
+    with tracked_files_lock:
+        info = tracked_files.get(path)
+        if info is None or info.state != FILE_PENDING:
+            return
+        with info.lock:
+            info.inode = stat.st_ino
+            info.mod_time = stat.st_mtime_ns
+            info.last_size = stat.st_size
+            info.rounds_stable = STABILITY_REQUIRED_ROUNDS - 1
+        # Give the writer a full interval to reopen the file
+        info.next_check = time.monotonic() + STABILITY_CHECK_INTERVAL
+        heapq.heappush(pending_deadlines, (info.next_check, path))
+    logging.info(f"File closed after writing, checked once more: {path}")
+
 
+def scan_directory():
+    """Scan the directory for new files."""
+    for entry in walk_files(WATCH_DIR):
+        if is_new_file(entry.path, entry):
+            logging.info(f"Scanner found new file: {entry.path}")
+            add_file_to_pending(entry.path)
 
-def add_file_to_pending(path):
+
+def add_file_to_pending(path, output_names=None):
     """
     Register (or re-register) a file for stability checks before processing.
-    We only do so if it's really a video (ffprobe-based check).
+    We only do so if it's really a video (ffprobe-based check)
+    and its 1080p output doesn't exist yet.
+    Beyond MAX_PENDING_FILES the file is left for a later scan.
+    Returns whether the file is tracked.
     """
-    with pending_files_lock:
-        if path not in pending_files:
+    global pending_count
+    if output_exists(build_output_path(path), output_names):
+        logging.debug(f"Output already exists, skipping: {path}")
+        return False
+    with tracked_files_lock:
+        if path not in tracked_files:
+            if pending_count >= MAX_PENDING_FILES:
+                logging.warning(
+                    f"Too many pending files, leaving for next scan: {path}")
+                return False
+            pending_count += 1
             logging.info(f"File queued for stability checks: {path}")
-            pending_files[path] = FileInfo()
+            info = FileInfo()
+            info.next_check = time.monotonic() + STABILITY_CHECK_INTERVAL
+            tracked_files[path] = info
+            heapq.heappush(pending_deadlines, (info.next_check, path))
         else:
             logging.debug(f"File re-queued for stability checks: {path}")
+    return True
 
 
 class FileInfo:
     """
     Tracks info about a file to see if it remains stable
     """
+    __slots__ = ("last_size", "mod_time", "inode", "rounds_stable",
+                 "next_check", "state", "lock")
+
     def __init__(self):
-        self.size_history = []
+        # Size at the last check, -1 before the first one
+        self.last_size = -1
         self.mod_time = 0
+        self.inode = 0
         self.rounds_stable = 0
+        self.next_check = 0
+        self.state = FILE_PENDING
+        # Guards stability round updates
+        self.lock = threading.Lock()
 
 
-def stability_checker():
+def output_exists(output_path, output_names=None):
     """
-    Thread function: periodically checks each pending file.
-    If stable for enough rounds and not locked, we process it.
+    Check whether an output file exists.
+    With an output_names dict, answers from one cached listing per
+    output directory instead of a stat per file.
     """
-    while True:
-        time.sleep(STABILITY_CHECK_INTERVAL)
-        check_pending_files()
+    if output_names is None:
+        return os.path.exists(output_path)
+    dir_path, name = os.path.split(output_path)
+    names = output_names.get(dir_path)
+    if names is None:
+        try:
+            names = set(os.listdir(dir_path))
+        except OSError:
+            names = set()
+        output_names[dir_path] = names
+    return name in names
 
 
 def split_file_name(name):
@@ -215,94 +539,542 @@ def split_file_name(name):
     """
     dir_path, filename = os.path.split(name)
     base, ext = os.path.splitext(filename)
-    # Regex pattern to match " - {Tag}" only at the end of the string
-    pattern = r" - [^()]+$"
     # Remove the optional tag and " - " if present
-    base = re.sub(pattern, "", base)
+    base = FILE_TAG_PATTERN.sub("", base)
     return dir_path, base, ext
 
 
+@functools.lru_cache(maxsize=16384)
+def build_output_path(input_path, tag="1080p"):
+    """
+    Build the output path of a video for a resolution tag.
+    Uses dir_path and then replaces the root directory prefix
+    to preserve subdirectory structure.
+    """
+    dir_path, base, ext = split_file_name(input_path)
+    if dir_path == WATCH_DIR:
+        output_dir_path = OUTPUT_DIR
+    elif dir_path.startswith(WATCH_PREFIX):
+        output_dir_path = OUTPUT_PREFIX + dir_path[len(WATCH_PREFIX):]
+    else:
+        output_dir_path = dir_path
+    return os.path.join(output_dir_path, f"{base} - {tag}{ext}")
+
+
 def check_pending_files():
-    with pending_files_lock:
-        to_remove = []
-        for path, info in pending_files.items():
-            if not os.path.exists(path):
-                logging.warning(f"File disappeared: {path}")
-                to_remove.append(path)
+    """
+    Check pending files whose next check deadline has expired.
+    Deadlines are kept in a heap, so only due files are touched per tick.
+    The tracked files lock only guards structural changes, stability rounds
+    run under each file's own lock so producers aren't blocked meanwhile.
+    """
+    global pending_count
+    now = time.monotonic()
+    due_files = []
+    with tracked_files_lock:
+        while pending_deadlines and pending_deadlines[0][0] <= now:
+            deadline, path = heapq.heappop(pending_deadlines)
+            info = tracked_files.get(path)
+            if (info is None or info.state != FILE_PENDING
+                    or info.next_check != deadline):
+                # Stale entry of a removed or re-queued file
                 continue
-            # Check if file is in use by another process
-            if is_file_in_use(path):
-                logging.debug(
-                    f"File is in use by another process, skipping: {path}")
-                info.rounds_stable = 0
+            due_files.append((path, info))
+    if not due_files:
+        return
+
+    # One /proc pass answers "is it open?" for every due file this tick
+    open_files = scan_open_files()
+    # Rounds are open/flock/stat syscalls that may block on network mounts,
+    # so run them concurrently when several files are due
+    if len(due_files) > 1:
+        rounds = check_executor.map(
+            check_pending_round, due_files, [open_files] * len(due_files))
+    else:
+        rounds = [check_pending_round(due_files[0], open_files)]
+    checked_files = [
+        (path, info, outcome)
+        for (path, info), outcome in zip(due_files, rounds)]
+
+    stable_files = []
+    with tracked_files_lock:
+        for path, info, outcome in checked_files:
+            if (tracked_files.get(path) is not info
+                    or info.state != FILE_PENDING):
+                # Taken over by another thread meanwhile
                 continue
-            # Check files last modification time
-            mod_time = os.path.getmtime(path)
-            if info.mod_time != mod_time:
-                info.mod_time = mod_time
-                info.rounds_stable = 0
-            # Check size stability
-            size_now = os.path.getsize(path)
-            if info.size_history and size_now == info.size_history[-1]:
-                # Size unchanged vs. last check
-                info.rounds_stable += 1
+            # Branch on the round's outcome only, rounds_stable may have
+            # been reset by a close since
+            if outcome == ROUND_STABLE:
+                pending_count -= 1
+                stable_files.append((path, info))
+                # Keep scanners off the file while it's probed
+                info.state = FILE_QUEUED
+            elif outcome == ROUND_GONE:
+                pending_count -= 1
+                del tracked_files[path]
             else:
-                # Size changed or first time check
-                info.rounds_stable = 0
-            # Add size to history and trim list to max 5 last checks
-            info.size_history.append(size_now)
-            if len(info.size_history) > 5:
-                info.size_history.pop(0)
-            # If stable for STABILITY_REQUIRED_ROUNDS intervals, process
-            if info.rounds_stable >= STABILITY_REQUIRED_ROUNDS:
-                logging.info(f"File is stable, processing: {path}")
-                if not is_video(path):
-                    logging.debug(f"File not a video: {path}")
-                    skippable_files[path] = info
-                else:
-                    process_file(path)
+                info.next_check = now + STABILITY_CHECK_INTERVAL
+                heapq.heappush(pending_deadlines, (info.next_check, path))
+
+    # Probe stable files concurrently, without blocking the main loop:
+    # results are applied by the probe threads as they complete
+    for path, info in stable_files:
+        future = probe_executor.submit(probe_stable_file, path)
+        future.add_done_callback(
+            functools.partial(queue_probed_file, path, info))
+
+
+def queue_probed_file(path, info, future):
+    """
+    Done callback of a stable file's probe:
+    queue it for processing if it's a video, skip it otherwise.
+    """
+    if future.cancelled():
+        # Shutting down, the file is picked up again on next start
+        return
+    try:
+        video = future.result()
+    except Exception as e:
+        logging.error(f"Error probing {path}: {e}")
+        video = None
+    if not video:
+        logging.debug(f"File not a video: {path}")
+        with tracked_files_lock:
+            info.state = FILE_SKIPPABLE
+        if video is False:
+            # Only a definite answer is kept across restarts
+            store_skipped(path, info)
+    else:
+        logging.info(f"File is stable, queued for processing: {path}")
+        job_queue.put(path)
+
+
+def transcode_worker(cpus=None):
+    """
+    Thread function: takes stable files from the job queue and processes them,
+    so long transcodes don't block stability checks.
+    ffmpeg runs of the worker are pinned to its own CPU set, if any.
+    """
+    worker_state.cpus = cpus
+    while True:
+        path = job_queue.get()
+        if path is None or terminate.is_set():
+            # Shutting down, queued files are picked up again on next start
+            job_queue.task_done()
+            break
+        try:
+            logging.info(f"Processing: {path}")
+            process_file(path)
+        except Exception as e:
+            if terminate.is_set():
+                logging.info(f"Processing interrupted by shutdown: {path}")
+            else:
+                logging.exception(f"Error processing {path}: {e}")
+        finally:
+            with tracked_files_lock:
+                info = tracked_files.get(path)
+                if info is not None and info.state == FILE_QUEUED:
                     if os.path.exists(path):
-                        processed_files[path] = info
-                to_remove.append(path)
-        # Remove processed or disappeared files
-        for r in to_remove:
-            pending_files.pop(r, None)
+                        info.state = FILE_PROCESSED
+                    else:
+                        del tracked_files[path]
+            job_queue.task_done()
 
 
-def is_file_in_use(path):
+def split_cpus(workers):
     """
-    Check via `lsof` if the file is used by another process.
-    If returncode == 0 AND there's output, it's open. Otherwise, not in use.
+    Split CPUs available to the process into one set per worker,
+    None for every worker if there's nothing to split.
+    """
+    cpus = sorted(os.sched_getaffinity(0))
+    if workers < 2 or len(cpus) < workers:
+        return [None] * workers
+    size, extra = divmod(len(cpus), workers)
+    cpu_sets = []
+    start = 0
+    for index in range(workers):
+        end = start + size + (1 if index < extra else 0)
+        cpu_sets.append(cpus[start:end])
+        start = end
+    return cpu_sets
+
+
+def ffmpeg_threads(backend):
+    """
+    Thread count of ffmpeg runs: FFMPEG_THREADS if set, otherwise
+    worker CPU count for software encodes or a fixed few for hardware ones.
+    """
+    if FFMPEG_THREADS:
+        return FFMPEG_THREADS
+    if backend != "software":
+        return HARDWARE_FFMPEG_THREADS
+    cpus = getattr(worker_state, "cpus", None)
+    return len(cpus) if cpus else 0
+
+
+def check_pending_round(due_file, open_files):
+    """Run one stability round of a (path, info) pair under the file's lock."""
+    path, info = due_file
+    with info.lock:
+        return check_pending_file(path, info, open_files)
+
+
+def check_pending_file(path, info, open_files):
+    """
+    Run one stability round for a pending file.
+    Returns its outcome: ROUND_PENDING, ROUND_STABLE or ROUND_GONE.
     """
     try:
-        result = subprocess.run(["lsof", "--", path], check=False, text=True,
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode == 0 and result.stdout.strip():
-            return True
+        stat = os.stat(path)
+    except FileNotFoundError:
+        logging.warning(f"File disappeared: {path}")
+        return ROUND_GONE
+    # Check if file is in use by another process
+    if is_file_in_use(path, open_files):
+        logging.debug(
+            f"File is in use by another process, skipping: {path}")
+        info.rounds_stable = 0
+        return ROUND_PENDING
+    # Check files inode and last modification time
+    if info.inode != stat.st_ino or info.mod_time != stat.st_mtime_ns:
+        info.inode = stat.st_ino
+        info.mod_time = stat.st_mtime_ns
+        info.rounds_stable = 0
+    # Check size stability
+    size_now = stat.st_size
+    if size_now == info.last_size:
+        # Size unchanged vs. last check
+        info.rounds_stable += 1
+    else:
+        # Size changed or first time check
+        info.rounds_stable = 0
+        if info.last_size != -1:
+            # Probes of a file still being written are stale, while
+            # those of previous runs or startup warm probes are kept
+            invalidate_probe(path)
+    info.last_size = size_now
+    # Stable for STABILITY_REQUIRED_ROUNDS intervals
+    if info.rounds_stable >= STABILITY_REQUIRED_ROUNDS:
+        return ROUND_STABLE
+    return ROUND_PENDING
+
+
+def probe_stable_file(path):
+    """
+    Check that a stable file is a video and warm up its ffprobe cache.
+    Returns None if mediainfo failed to tell, like is_video.
+    Runs on the probe executor.
+    """
+    if not is_video_candidate(path):
         return False
+    video = is_video(path)
+    if not video:
+        return video
+    try:
+        probe_video(path)
     except Exception as e:
-        logging.exception(f"Error checking file usage for {path}: {e}")
+        logging.debug(f"Error probing {path}: {e}")
+    return True
+
+
+def scan_open_files():
+    """
+    Collect real paths of all files currently open by any process
+    by reading /proc/<pid>/fd links directly.
+    Links are resolved with readlinkat() relative to an opened fd directory,
+    so the kernel doesn't walk /proc/<pid>/fd for every descriptor.
+    Returns None if /proc is not available (non-Linux).
+    """
+    if not os.path.isdir("/proc"):
+        return None
+    own_pid = str(os.getpid())
+    watch_prefix = os.path.join(os.path.realpath(WATCH_DIR), "")
+    open_files = set()
+    with os.scandir("/proc") as procs:
+        for proc in procs:
+            if not proc.name.isdigit() or proc.name == own_pid:
+                continue
+            try:
+                dir_fd = os.open(f"/proc/{proc.name}/fd",
+                                 os.O_RDONLY | os.O_DIRECTORY)
+            except OSError:
+                # Process exited or access denied
+                continue
+            try:
+                for fd in os.listdir(dir_fd):
+                    try:
+                        target = os.readlink(fd, dir_fd=dir_fd)
+                    except OSError:
+                        # fd closed while iterating
+                        continue
+                    # Only paths inside the watch dir are of interest
+                    if target.startswith(watch_prefix):
+                        open_files.add(target)
+            except OSError:
+                continue
+            finally:
+                os.close(dir_fd)
+    return open_files
+
+
+def is_file_in_use(path, open_files=None):
+    """
+    Check if the file is used by another process.
+    A writer holding a POSIX lock is detected with a non-blocking flock,
+    others via the /proc snapshot from `scan_open_files`, if given.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError as e:
+        logging.debug(f"Error checking file usage for {path}: {e}")
         # If we fail, assume not in use
         return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    except BlockingIOError:
+        return True
+    except OSError as e:
+        logging.debug(f"Error locking {path}: {e}")
+    finally:
+        os.close(fd)
+    if open_files is None:
+        return False
+    return os.path.realpath(path) in open_files
 
 
-def get_video_resolution(video_path):
+def probe_video(video_path):
     """
-    Retrieve the resolution of the video using ffprobe.
+    Retrieve codec, resolution and frame-rate of the first video stream,
+    subtitle streams and overall bit-rate of the file
+    using a single ffprobe call.
+    Results are memoized by (path, mtime, size), so one ffprobe call
+    serves every lookup until the file changes.
     """
-    try:
+    stat = os.stat(video_path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with probe_cache_lock:
+        cached = lookup_probe(video_path)
+    if cached and cached[0] == stamp:
+        return cached[1]
+
+    # Header info is enough for most containers, probe without caps
+    # if the capped probe found nothing or there's no header (MPEG-TS)
+    if os.path.splitext(video_path)[1].lower() in MPEG_TS_EXTENSIONS:
+        probe_caps = ((),)
+    else:
+        probe_caps = (FFPROBE_CAPS, ())
+    for caps in probe_caps:
         cmd = [
             "ffprobe",
             "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=width,height",
+            *caps,
+            "-show_entries",
+            "stream=codec_type,codec_name,width,height,avg_frame_rate"
+            ":stream_tags=language,title:format=bit_rate",
             "-of", "json",
             video_path
         ]
-        logging.info(f"[CMD] get_video_resolution: {' '.join(cmd)}")
+        logging.info(f"[CMD] probe_video: {shlex.join(cmd)}")
         result = subprocess.run(cmd, check=True, text=True,
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stream = json.loads(result.stdout).get("streams", [ dict() ])[0]
+        stream = parse_video_probe(result.stdout)
+        if stream.get("width") and stream.get("height"):
+            break
+    with probe_cache_lock:
+        remember_probe(video_path, (stamp, stream))
+        store_probe(video_path, stamp, stream)
+    return stream
+
+
+def lookup_probe(video_path):
+    """
+    Get a cached probe as (stamp, stream) from memory,
+    or from the on-disk cache if it was evicted or not loaded.
+    Must be called with probe_cache_lock held.
+    """
+    cached = probe_cache.get(video_path)
+    if cached is not None:
+        probe_cache.move_to_end(video_path)
+        return cached
+    if probe_db is None:
+        return None
+    try:
+        row = probe_db.execute(
+            "SELECT mtime_ns, size, stream FROM probes WHERE path = ?",
+            (video_path,)).fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"Error reading probe cache for {video_path}: {e}")
+        return None
+    if row is None:
+        return None
+    cached = ((row[0], row[1]), json.loads(row[2]))
+    remember_probe(video_path, cached)
+    return cached
+
+
+def remember_probe(video_path, cached):
+    """
+    Keep a probe in memory, evicting least recently used ones
+    beyond PROBE_CACHE_SIZE. Must be called with probe_cache_lock held.
+    """
+    probe_cache[video_path] = cached
+    probe_cache.move_to_end(video_path)
+    while len(probe_cache) > PROBE_CACHE_SIZE:
+        probe_cache.popitem(last=False)
+
+
+def parse_video_probe(output):
+    """
+    Parse ffprobe JSON into codec, resolution and frame-rate
+    of the first video stream, subtitle streams in file order
+    and bit_rate of the format
+    """
+    probe = json.loads(output or "{}")
+    streams = probe.get("streams", [])
+    stream = {}
+    video = next(
+        (s for s in streams if s.get("codec_type") == "video"), None)
+    if video:
+        stream = {"codec_name": video.get("codec_name", ""),
+                  "width": video.get("width", 0),
+                  "height": video.get("height", 0),
+                  "fps": parse_frame_rate(video.get("avg_frame_rate", ""))}
+    stream["subtitles"] = [
+        {"codec_name": s.get("codec_name", ""), "tags": s.get("tags", {})}
+        for s in streams if s.get("codec_type") == "subtitle"]
+    bit_rate = probe.get("format", {}).get("bit_rate", "")
+    if bit_rate.isdigit():
+        stream["bit_rate"] = int(bit_rate)
+    return stream
+
+
+def parse_frame_rate(rate):
+    """Convert ffprobe "num/den" frame-rate to float, None if unknown."""
+    num, _, den = rate.partition("/")
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+def invalidate_probe(video_path):
+    """Drop cached ffprobe results of a file."""
+    with probe_cache_lock:
+        probe_cache.pop(video_path, None)
+        # A plain delete, reading the row first could evict other probes
+        store_probe(video_path, None, None)
+
+
+def open_probe_cache():
+    """
+    Open the on-disk ffprobe cache and load its most recent entries
+    into memory, so probes survive restarts. Entries are checked against
+    the file's (mtime, size) on lookup, as in-memory ones.
+    """
+    global probe_db
+    try:
+        probe_db = sqlite3.connect(PROBE_CACHE_FILE, check_same_thread=False)
+        probe_db.execute("PRAGMA journal_mode=WAL")
+        # Probes of older versions lack fields, start over
+        version = probe_db.execute("PRAGMA user_version").fetchone()[0]
+        if version != PROBE_CACHE_VERSION:
+            with probe_db:
+                probe_db.execute("DROP TABLE IF EXISTS probes")
+            probe_db.execute(f"PRAGMA user_version = {PROBE_CACHE_VERSION}")
+        probe_db.execute(
+            "CREATE TABLE IF NOT EXISTS probes ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, stream TEXT)")
+        # Files found not to be videos, skipped until they change
+        probe_db.execute(
+            "CREATE TABLE IF NOT EXISTS skipped ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER)")
+        # Replaced rows get a new rowid, so it orders them by last write
+        rows = probe_db.execute(
+            "SELECT path, mtime_ns, size, stream FROM probes "
+            "ORDER BY rowid DESC LIMIT ?", (PROBE_CACHE_SIZE,)).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Error opening probe cache {PROBE_CACHE_FILE}: {e}")
+        probe_db = None
+        return
+    with probe_cache_lock:
+        for path, mtime_ns, size, stream in reversed(rows):
+            remember_probe(path, ((mtime_ns, size), json.loads(stream)))
+    logging.info(f"Loaded {len(rows)} cached probes from {PROBE_CACHE_FILE}")
+
+
+def store_probe(video_path, stamp, stream):
+    """
+    Write a probe result to the on-disk cache, or delete it if stream is None.
+    Must be called with probe_cache_lock held.
+    """
+    if probe_db is None:
+        return
+    try:
+        with probe_db:
+            if stream is None:
+                probe_db.execute(
+                    "DELETE FROM probes WHERE path = ?", (video_path,))
+            else:
+                probe_db.execute(
+                    "INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?)",
+                    (video_path, *stamp, json.dumps(stream)))
+    except sqlite3.Error as e:
+        logging.error(f"Error updating probe cache for {video_path}: {e}")
+
+
+def store_skipped(path, info):
+    """Remember on disk that a file is not a video, as of its mtime and size."""
+    if probe_db is None:
+        return
+    with probe_cache_lock:
+        try:
+            with probe_db:
+                probe_db.execute(
+                    "INSERT OR REPLACE INTO skipped VALUES (?, ?, ?)",
+                    (path, info.mod_time, info.last_size))
+        except sqlite3.Error as e:
+            logging.error(f"Error updating probe cache for {path}: {e}")
+
+
+def load_skipped_files():
+    """
+    Read files skipped by previous runs as a dict of
+    path -> (mtime_ns, size).
+    """
+    if probe_db is None:
+        return {}
+    with probe_cache_lock:
+        try:
+            rows = probe_db.execute(
+                "SELECT path, mtime_ns, size FROM skipped").fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"Error reading probe cache {PROBE_CACHE_FILE}: {e}")
+            return {}
+    return {path: (mtime_ns, size) for path, mtime_ns, size in rows}
+
+
+def forget_skipped_files(paths):
+    """Drop skipped files that are gone or changed from the on-disk cache."""
+    if probe_db is None or not paths:
+        return
+    with probe_cache_lock:
+        try:
+            with probe_db:
+                probe_db.executemany(
+                    "DELETE FROM skipped WHERE path = ?",
+                    [(path,) for path in paths])
+        except sqlite3.Error as e:
+            logging.error(f"Error updating probe cache {PROBE_CACHE_FILE}: {e}")
+
+
+def get_video_resolution(video_path):
+    """
+    Retrieve the resolution of the video using ffprobe.
+    """
+    try:
+        stream = probe_video(video_path)
         width = int(stream.get("width", 0))
         height = int(stream.get("height", 0))
         logging.info(
@@ -315,106 +1087,200 @@ def get_video_resolution(video_path):
 
 # wrapper around ffmpeg call returning success status
 def render_file(input_path, output_path, params):
-    ffmpeg_cmd = build_ffmpeg_command(input_path, output_path, params)
-
-    try:
-        subprocess.run(ffmpeg_cmd, check=True, text=True,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return True
-    except subprocess.CalledProcessError as e:
-        logging.error(
-            f"[ERROR] {input_path}: Return code "
-            f"{e.returncode}\n"
-            f"{e.stderr}")
-
-    if GPU_ACCEL == ["amd", "rockchip"]:
-        logging.warning(f"Falling back to software.")
-        ffmpeg_cmd = build_ffmpeg_command_software(
-            input_path, output_path, params)
+    backend = select_backend(params.get('source_codec'))
+    while True:
+        ffmpeg_cmds = build_ffmpeg_command(
+            input_path, output_path, params, backend)
+        semaphore = cpu_semaphore if backend == "software" else gpu_semaphore
 
         try:
-            subprocess.run(ffmpeg_cmd, check=True, text=True,
-                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            run_encoder(ffmpeg_cmds, semaphore)
             return True
         except subprocess.CalledProcessError as e:
-            logging.error(f"[ERROR] Software render attempt failed.")
+            logging.error(f"[ERROR] {backend} render attempt failed.")
             logging.error(
                 f"[ERROR] {input_path}: Return code "
                 f"{e.returncode}\n"
                 f"{e.stderr}")
+        finally:
+            remove_passlog_files(output_path)
 
-    return False
+        backend = BACKENDS[backend]["fallback"]
+        if backend is None or terminate.is_set():
+            return False
+        logging.warning(f"Falling back to {backend}.")
 
 
-def get_streams_info(video_path, stream_type="s"):
-    """Extract subtitle streams info using ffprobe."""
-    cmd = [
-        "ffprobe", "-v", "error",
-        "-select_streams", f"{stream_type}", "-show_entries",
-        "stream=index,codec_name,codec_type:stream_tags=title,language",
-        "-of", "json", video_path
-    ]
-    logging.info(f"[CMD] get_stream_info: {' '.join(cmd)}")
-    result = subprocess.run(cmd, check=True, text=True,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return json.loads(result.stdout).get("streams", [])
+def run_encoder(ffmpeg_cmds, semaphore):
+    """
+    Run ffmpeg commands in order once a GPU or CPU encoding slot is free.
+    """
+    cpus = getattr(worker_state, "cpus", None)
+    with semaphore:
+        for ffmpeg_cmd in ffmpeg_cmds:
+            if cpus:
+                # Keep concurrent encodes off each other's cores
+                ffmpeg_cmd = ["taskset", "-c", ",".join(map(str, cpus))] + ffmpeg_cmd
+            run_ffmpeg(ffmpeg_cmd)
 
 
-def build_temp_path(prefix, suffix):
-    """Build a name for temporary file."""
+def run_ffmpeg(ffmpeg_cmd):
+    """
+    Run an ffmpeg command with stderr written to an anonymous temp file,
+    so no pipe has to be drained from Python however long it runs.
+    Only the stderr tail is read back, on failure.
+    ffmpeg runs in its own process group, signalled as a whole on shutdown.
+    """
+    with tempfile.TemporaryFile() as stderr_file:
+        # Registered under the lock, so shutdown can't miss a starting run
+        with ffmpeg_processes_lock:
+            process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.DEVNULL,
+                                       stderr=stderr_file,
+                                       start_new_session=True)
+            ffmpeg_processes.add(process)
+            if terminate.is_set():
+                signal_ffmpeg(process, signal.SIGTERM)
+        try:
+            returncode = process.wait()
+        finally:
+            with ffmpeg_processes_lock:
+                ffmpeg_processes.discard(process)
+        if returncode != 0:
+            size = stderr_file.seek(0, os.SEEK_END)
+            stderr_file.seek(max(0, size - FFMPEG_STDERR_TAIL))
+            stderr = stderr_file.read().decode(errors="replace")
+            raise subprocess.CalledProcessError(
+                returncode, ffmpeg_cmd, stderr=stderr)
+
+
+def signal_ffmpeg(process, signum):
+    """Send a signal to the process group of a running ffmpeg."""
+    # Not once reaped, its pid may be reused
+    if process.poll() is not None:
+        return
+    try:
+        os.killpg(process.pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def get_subtitle_streams(video_path):
+    """Get subtitle streams info from the cached ffprobe call."""
+    return probe_video(video_path).get("subtitles", [])
+
+
+def build_temp_path(prefix, suffix, dir=None):
+    """
+    Build a name for temporary file, in the system temp dir by default.
+    Files released there with `release_temp_path` are reused first.
+    """
+    if dir is None:
+        with temp_pool_lock:
+            pooled_paths = temp_pool.get(suffix)
+            if pooled_paths:
+                return pooled_paths.pop()
     temp_file = tempfile.NamedTemporaryFile(
-        prefix=prefix, suffix=suffix, delete=False)
+        prefix=prefix, suffix=suffix, dir=dir, delete=False)
     output_path = temp_file.name
     TEMP_FILES.append(output_path)
     temp_file.close()
     return output_path
 
 
+def release_temp_path(path):
+    """
+    Truncate a temporary file and keep it for reuse,
+    or remove it if the pool for its suffix is full.
+    """
+    suffix = os.path.splitext(path)[1]
+    with temp_pool_lock:
+        pooled_paths = temp_pool.setdefault(suffix, [])
+        if len(pooled_paths) < TEMP_POOL_SIZE:
+            os.truncate(path, 0)
+            pooled_paths.append(path)
+            return
+    os.remove(path)
+    untrack_temp_path(path)
+
+
+def untrack_temp_path(path):
+    """Forget a temporary file that was moved or removed."""
+    try:
+        TEMP_FILES.remove(path)
+    except ValueError:
+        pass
+
+
 def transcode_through_temp(input_path, output_path, ext, params):
-    temp_path = build_temp_path("scaler_", ext)
+    # Temp file next to the output, so the final move is a rename
+    temp_path = build_temp_path(
+        TEMP_VIDEO_PREFIX, ext, os.path.dirname(output_path))
     logging.info(f"[PROCESS] {input_path} -> {temp_path}")
-    if render_file(input_path, temp_path, params):
-        logging.info(f"[DONE] {temp_path}")
-        # Move to final output path
-        logging.info(f"[MOVE] {temp_path} -> {output_path}")
-        shutil.move(temp_path, output_path)
-
-    # Ensure temp file is cleaned if something went wrong
-    if os.path.exists(temp_path):
-        os.remove(temp_path)
-        logging.info(f"Cleaned up temporary file: {temp_path}")
+    try:
+        if render_file(input_path, temp_path, params):
+            logging.info(f"[DONE] {temp_path}")
+            # Move to final output path
+            logging.info(f"[MOVE] {temp_path} -> {output_path}")
+            move_without_replacing(temp_path, output_path)
+    finally:
+        # Ensure temp file is cleaned if something went wrong
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+            logging.info(f"Cleaned up temporary file: {temp_path}")
+        untrack_temp_path(temp_path)
+
+
+def move_without_replacing(src, dst):
+    """
+    Move a file, raising FileExistsError if dst exists.
+    Hard-linking then unlinking never replaces dst, even one written
+    meanwhile by someone else; where hard links aren't supported
+    it falls back to a move after an existence check.
+    """
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        raise
+    except OSError:
+        if os.path.exists(dst):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+        shutil.move(src, dst)
+        return
+    os.remove(src)
 
 
 def extract_subtitles(video_path, streams):
-    """Extract subtitle streams using ffmpeg."""
-    cmd = ["ffmpeg", "-y", "-i", video_path]
+    """Extract subtitle streams as SubRip using ffmpeg."""
+    cmd = ["ffmpeg", "-y", "-nostats", "-i", video_path]
     for stream in streams:
         index = stream['index']
-        output_path = stream['orig_subs']
-        cmd += ["-map", f"0:s:{index}", output_path]
-    logging.info(f"[CMD] extract_subtitles: {' '.join(cmd)}")
-    subprocess.run(cmd, check=True, text=True,
-                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output_path = stream['conv_subs']
+        cmd += ["-map", f"0:s:{index}", "-c:s", "srt", output_path]
+    logging.info(f"[CMD] extract_subtitles: {shlex.join(cmd)}")
+    run_ffmpeg(cmd)
 
 
 def process_subtitles(input_path):
     """
-    Process some subtitles' codecs,
-    as Jellyfin-ffmpeg is unable to transcode them.
+    Process some subtitles' codecs: ASS/SSA streams are converted to srt
+    by the transcoding ffmpeg run itself, or extracted to srt files
+    beforehand if EXTRACT_SUBTITLES is set.
+    Returns ffmpeg maps, extracted files and the number of converted streams.
     """
     subtitle_maps = []
     streams_to_extract = []
-    subtitle_streams = get_streams_info(input_path)
-    for stream in subtitle_streams:
-        index = subtitle_streams.index(stream)
+    converted = 0
+    # Streams are in file order, their position is the subtitle stream index
+    for index, stream in enumerate(get_subtitle_streams(input_path)):
         codec = stream["codec_name"]
-        if codec in ["ass", "ssa"]:  # Advanced SubStation Alpha
-            # extract subtitles and convert them
-            orig_subs = build_temp_path(
-                f"sub_{index}_", SUBS_CODEC_TO_EXTENSION[codec])
+        if codec in ["ass", "ssa"] and not EXTRACT_SUBTITLES:
+            # converted inline, stream metadata is kept by ffmpeg
+            subtitle_maps.append(["-map", f"0:s:{index}", f"-c:s:{index}", "srt"])
+            converted += 1
+        elif codec in ["ass", "ssa"]:  # Advanced SubStation Alpha
+            # extract subtitles converted to srt
             conv_subs = build_temp_path(f"sub_{index}_", ".srt")
-            streams_to_extract.append(
-                {'index': index, 'orig_subs': orig_subs, 'conv_subs': conv_subs})
+            streams_to_extract.append({'index': index, 'conv_subs': conv_subs})
             # maps for ffmpeg
             file_index = len(streams_to_extract)  # counts from 1
             lang = stream['tags']['language']
@@ -423,38 +1289,53 @@ def process_subtitles(input_path):
                 f"-map", f"{file_index}",
                 f"-c:s:{index}", "srt",
                 f"-metadata:s:s:{index}", f"language={lang}",
-                f"-metadata:s:s:{index}", f"title='{title}'",
+                f"-metadata:s:s:{index}", f"title={title}",
             ])
         else:
             # codec copied as is
             subtitle_maps.append(["-map", f"0:s:{index}", f"-c:s:{index}", "copy"])
 
-    if len(streams_to_extract) == 0:
+    converted += len(streams_to_extract)
+    if converted == 0:
         if subtitle_maps:
             logging.info(
                 f"Found no subtitle streams to convert. "
                 f"Coping all subtitles as is")
-            return {'files': [], 'maps': [["-map", "0:s", "-c:s", "copy"]]}
+            return {'files': [], 'maps': [["-map", "0:s", "-c:s", "copy"]],
+                    'converted': 0}
         else:
             logging.info("Found no subtitle streams found at all")
-            return {'files': [], 'maps': []}
+            return {'files': [], 'maps': [], 'converted': 0}
 
-    # extract subtitles to temp files
-    extract_subtitles(input_path, streams_to_extract)
-    # convert subtitles to srt format
-    for stream in streams_to_extract:
-        convert_subtitle(stream['orig_subs'], stream['conv_subs'])
-
-    # remove original subtitles files
-    for stream in streams_to_extract:
-        os.remove(stream['orig_subs'])
-    logging.info("Removed original subtitles files")
+    if streams_to_extract:
+        # extract subtitles to temp srt files
+        extract_subtitles(input_path, streams_to_extract)
 
     return {'files': [stream['conv_subs']
-                      for stream in streams_to_extract], 'maps': subtitle_maps}
+                      for stream in streams_to_extract], 'maps': subtitle_maps,
+            'converted': converted}
 
 
 def process_file(input_path):
+    """
+    Transcode the video, one source at a time per output:
+    sources differing only by tag (e.g. "X - WEB" and "X - BluRay")
+    share outputs, and the second one finds them done.
+    """
+    output_key = build_output_path(input_path)
+    with busy_outputs_cond:
+        while output_key in busy_outputs:
+            busy_outputs_cond.wait()
+        busy_outputs.add(output_key)
+    try:
+        transcode_file(input_path)
+    finally:
+        with busy_outputs_cond:
+            busy_outputs.discard(output_key)
+            busy_outputs_cond.notify_all()
+
+
+def transcode_file(input_path):
     """
     Transcode the video while preserving metadata and aspect ratio.
     """
@@ -464,21 +1345,24 @@ def process_file(input_path):
         return
     is_4k = (width >= 3840) or (height >= 2160)
 
-    # Using dir_path and then replacing the root directory to preserve subdirectory structure
-    dir_path, base, ext = split_file_name(input_path)
-    output_dir_path = dir_path.replace(WATCH_DIR, OUTPUT_DIR)
+    ext = os.path.splitext(input_path)[1]
+    output_path_4k = build_output_path(input_path, "4k")
+    output_path_1080p = build_output_path(input_path, "1080p")
+    output_dir_path = os.path.dirname(output_path_1080p)
     os.makedirs(output_dir_path, exist_ok=True)
     modify_permissions(output_dir_path)
-    output_path_4k = os.path.join(output_dir_path, f"{base} - 4k{ext}")
-    output_path_1080p = os.path.join(output_dir_path, f"{base} - 1080p{ext}")
 
     default_path, scaled_path = (
         output_path_4k, output_path_1080p) if is_4k else (
         output_path_1080p, "")
     do_transcoding = not os.path.exists(default_path)
     do_scaled_transcoding = is_4k and not os.path.exists(scaled_path)
+    if not do_transcoding and not do_scaled_transcoding:
+        logging.info(f"Skipping {input_path}: Already processed")
+        return
 
-    # process subtitles first to WA Jellyfin-ffmpeg issue
+    # process subtitles first, extracting them works around
+    # Jellyfin-ffmpeg builds unable to convert them inline
     subs = process_subtitles(input_path)
     # video frame-rate
     video_fps = get_video_fps(input_path)
@@ -497,22 +1381,18 @@ def process_file(input_path):
     logging.info(f"Source codec: {source_codec}")
     params = {'subs': subs, 'bitrate': bitrate, 'source_codec': source_codec}
 
-    if not do_transcoding and not do_scaled_transcoding:
-        logging.info(f"Skipping {input_path}: Already processed")
-        return
-
     if do_transcoding:
         # only rename original file if nothing to be changed
-        if GET_BY_WITH_RENAMING and source_codec in ['h264', 'hevc', 'av1'] and len(subs['files']) == 0 and bitrate == orig_bitrate:
+        if GET_BY_WITH_RENAMING and source_codec in ['h264', 'hevc', 'av1'] and subs['converted'] == 0 and bitrate == orig_bitrate:
             logging.info(f"Transcoding without rescale is excessive")
             if input_path != default_path:
                 logging.info(f"[MOVE] {input_path} -> {default_path}")
-                shutil.move(input_path, default_path)
+                move_without_replacing(input_path, default_path)
                 input_path = default_path
         else:
             if source_codec not in ['h264', 'hevc', 'av1']:
                 logging.info("Transcoding without rescale: codec changed from {source_codec}")
-            elif len(subs['files']) > 0:
+            elif subs['converted'] > 0:
                 logging.info("Transcoding without rescale: subs re-encoded")
             elif bitrate != orig_bitrate:
                 logging.info("Transcoding without rescale: bitrate changed")
@@ -541,23 +1421,22 @@ def process_file(input_path):
         logging.info(f"Cleaned up original file: {input_path}")
         # delete parent directories if empty
         parent_path = os.path.dirname(input_path)
-        while os.path.normpath(parent_path) != os.path.normpath(WATCH_DIR):
-            if not os.path.isdir(parent_path):
-                break
-            if len(os.listdir(parent_path)) == 0:
-                try:
-                    os.rmdir(parent_path)
-                except Exception as e:
+        # Paths under WATCH_DIR are already normalized
+        while parent_path.startswith(WATCH_PREFIX):
+            # rmdir itself fails on non-empty directories,
+            # no need to list them first
+            try:
+                os.rmdir(parent_path)
+            except OSError as e:
+                if e.errno != errno.ENOTEMPTY:
                     logging.debug(f"Error removing directory '{parent_path}': {e}")
-                    break
-            else:
                 break
             parent_path = os.path.dirname(parent_path)
 
     # Delete all subtitle files
     if subs['files']:
         for sub in subs['files']:
-            os.remove(sub)
+            release_temp_path(sub)
         logging.info("Cleaned up subtitles")
 
 
@@ -570,11 +1449,14 @@ def modify_permissions(file_path):
 
 
 def is_video(path):
-    """Checks via mediainfo: frame count should be greater then zero."""
+    """
+    Checks via mediainfo: frame count should be greater then zero.
+    Returns None if mediainfo failed, so it's unknown.
+    """
     try:
         # Run the mediainfo command
         cmd = ["mediainfo", "--Output=Video;%FrameCount%", path]
-        logging.info(f"[CMD] is_video: {' '.join(cmd)}")
+        logging.info(f"[CMD] is_video: {shlex.join(cmd)}")
         result = subprocess.run(cmd, check=True, text=True,
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
@@ -586,24 +1468,19 @@ def is_video(path):
             return True
     except Exception as e:
         logging.debug(f"Error in is_video for {path}: {e}")
+        return None
 
     return False
 
 
 def get_video_fps(video_path):
     """
-    Get overall FPS via mediainfo
+    Get frame-rate of the video stream via ffprobe
     """
     try:
-        # Run the mediainfo command
-        cmd = ["mediainfo", "--Output=General;%FrameRate%", video_path]
-        logging.info(f"[CMD] get_video_fps: {' '.join(cmd)}")
-        result = subprocess.run(cmd, check=True, text=True,
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        # Retrieve the frame-rate from the output
-        fps_str = result.stdout.strip()
-        fps = float(fps_str)
-        return fps
+        fps = probe_video(video_path).get("fps")
+        if fps:
+            return fps
     except Exception as e:
         logging.debug(f"Error in get_video_fps for {video_path}: {e}")
 
@@ -613,12 +1490,16 @@ def get_video_fps(video_path):
 
 def get_video_bitrate(video_path, max_bitrate):
     """
-    Get overall bitrate via mediainfo
+    Get overall bitrate via ffprobe, falling back to mediainfo
+    if the container doesn't report it
     """
     try:
+        bitrate = probe_video(video_path).get("bit_rate")
+        if bitrate:
+            return bitrate
         # Run the mediainfo command
         cmd = ["mediainfo", "--Output=General;%OverallBitRate%", video_path]
-        logging.info(f"[CMD] get_video_bitrate: {' '.join(cmd)}")
+        logging.info(f"[CMD] get_video_bitrate: {shlex.join(cmd)}")
         result = subprocess.run(cmd, check=True, text=True,
                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         # Retrieve the bit-rate from the output
@@ -641,18 +1522,7 @@ def get_video_codec(video_path):
     Identify the codec (h264, hevc, av1, etc.) via ffprobe.
     """
     try:
-        cmd = [
-            "ffprobe",
-            "-v", "error",
-            "-select_streams", "v:0",
-            "-show_entries", "stream=codec_name",
-            "-of", "json",
-            video_path
-        ]
-        logging.info(f"[CMD] get_video_codec: {' '.join(cmd)}")
-        result = subprocess.run(cmd, check=True, text=True,
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stream = json.loads(result.stdout).get("streams", [ dict() ])[0]
+        stream = probe_video(video_path)
         return stream.get("codec_name", "other")
     except Exception as e:
         logging.debug(f"Error in get_video_codec for {video_path}: {e}")
@@ -664,7 +1534,9 @@ def calculate_scaled_resolution(width, height, target_width=1920):
     Calculate the scaled resolution while preserving the aspect ratio.
     Adds padding if necessary to maintain the target height.
     """
-    scaled_height = math.ceil(target_width * height / width)
+    # target_width * height / width rounded to the nearest even integer,
+    # encoders reject odd dimensions of 4:2:0 video
+    scaled_height = (target_width * height + width) // (2 * width) * 2
     return target_width, scaled_height
 
 
@@ -672,150 +1544,188 @@ def calculate_scaled_resolution(width, height, target_width=1920):
 #  FFmpeg command-building logic for AMD vs. Rockchip + fallback
 # ----------------------------------------------------------------
 
-def build_ffmpeg_command(input_file, output_file, params):
+# Fixed parts of ffmpeg command lines, built once at start
+# since backend and device don't change at runtime.
+# -nostats keeps progress lines out of stderr, leaving errors only.
+# VAAPI decoded frames stay in GPU memory.
+AMD_FFMPEG_PREFIX = (
+    "ffmpeg", "-y", "-nostats",
+    "-hwaccel", "vaapi", "-hwaccel_output_format", "vaapi",
+    "-vaapi_device", AMD_VAAPI_DEVICE,
+)
+# Software decoding for sources VAAPI can't decode,
+# frames are uploaded to the GPU for scaling and encoding.
+AMD_UPLOAD_FFMPEG_PREFIX = (
+    "ffmpeg", "-y", "-nostats",
+    "-vaapi_device", AMD_VAAPI_DEVICE,
+)
+# RKMPP decoded frames stay in DRM PRIME buffers.
+ROCKCHIP_FFMPEG_PREFIX = (
+    "ffmpeg", "-y", "-nostats",
+    "-hwaccel", "rkmpp", "-hwaccel_output_format", "drm_prime",
+    "-afbc", "rga",
+)
+SOFTWARE_FFMPEG_PREFIX = ("ffmpeg", "-y", "-nostats")
+AUDIO_COPY_ARGS = ("-map", "0:a", "-c:a", "copy")
+OUTPUT_ARGS = ("-movflags", "+faststart")
+
+
+# Encoding backends: ffmpeg prefix, video encoder per source codec
+# with extra encoder arguments, filters used as is or when scaling,
+# and backend retried when encoding fails
+BACKENDS = {
+    "amd": {
+        # AMD VAAPI: hardware scaling, frames stay in GPU memory
+        "prefix": AMD_FFMPEG_PREFIX,
+        "encoders": {"h264": "h264_vaapi", "av1": "av1_vaapi"},
+        "default_encoder": "hevc_vaapi",
+        "encoder_args": {},
+        "filter": "scale_vaapi=format=nv12",
+        "scale_filter": "scale_vaapi=format=nv12:w={width}:h={height}",
+        "fallback": "amd_upload",
+    },
+    "amd_upload": {
+        # AMD VAAPI encoding of software decoded frames,
+        # e.g. 10-bit sources the driver can't decode
+        "prefix": AMD_UPLOAD_FFMPEG_PREFIX,
+        "encoders": {"h264": "h264_vaapi", "av1": "av1_vaapi"},
+        "default_encoder": "hevc_vaapi",
+        "encoder_args": {},
+        "filter": "format=nv12,hwupload",
+        "scale_filter": "format=nv12,hwupload,scale_vaapi=w={width}:h={height}",
+        "fallback": "software",
+    },
+    "rockchip": {
+        # Rockchip RKMPP: hardware scaling with RGA,
+        # AV1 encoding not supported (decode-only), software does it
+        "prefix": ROCKCHIP_FFMPEG_PREFIX,
+        "encoders": {"h264": "h264_rkmpp", "av1": None},
+        "default_encoder": "hevc_rkmpp",
+        "encoder_args": {},
+        "filter": None,
+        "scale_filter": "scale_rkrga=w={width}:h={height}:format=nv12",
+        "fallback": "software",
+    },
+    "software": {
+        "prefix": SOFTWARE_FFMPEG_PREFIX,
+        "encoders": {"h264": "libx264", "hevc": "libx265", "av1": "libaom-av1"},
+        "default_encoder": "libx265",
+        "encoder_args": {"libx264": ("-preset", "faster"),
+                         "libx265": ("-preset", "faster")},
+        "filter": None,
+        "scale_filter": "scale={width}:{height}",
+        "fallback": None,
+    },
+}
+
+
+def select_encoder(backend, source_codec):
+    """Video encoder of a backend for a source codec, None if unsupported."""
+    spec = BACKENDS[backend]
+    return spec["encoders"].get(source_codec, spec["default_encoder"])
+
+
+def select_backend(source_codec):
     """
-    Decide how to encode based on GPU_ACCEL.
+    Decide how to encode based on GPU_ACCEL,
+    software if the GPU is unknown or can't encode the source codec.
     """
-    if GPU_ACCEL == "amd":
-        return build_ffmpeg_command_amd(input_file, output_file, params)
-    elif GPU_ACCEL == "rockchip":
-        return build_ffmpeg_command_rockchip(input_file, output_file, params)
-    else:
+    if GPU_ACCEL not in BACKENDS:
         logging.warning(
             f"Unknown GPU_ACCEL={GPU_ACCEL}. Falling back to software.")
-        return build_ffmpeg_command_software(input_file, output_file, params)
+        return "software"
+    if select_encoder(GPU_ACCEL, source_codec) is None:
+        logging.info(
+            f"{GPU_ACCEL}: Falling back to software for {source_codec} encoding.")
+        return "software"
+    return GPU_ACCEL
 
 
-def build_ffmpeg_command_amd(input_file, output_file, params):
+def build_ffmpeg_command(input_file, output_file, params, backend):
     """
-    AMD VAAPI: can do h264_vaapi, hevc_vaapi, av1_vaapi, etc.
+    Build ffmpeg commands of an encoding backend,
+    preserving metadata/streams if requested.
+    Returns a single command, or an analysis and an encoding pass
+    for software encoding if ENABLE_TWO_PASS is set.
     """
     bitrate = str(params.get('bitrate'))
     subs = params.get('subs')
     resolution = params.get('resolution')
-    source_codec = params.get('source_codec')
+    spec = BACKENDS[backend]
+    two_pass = backend == "software" and ENABLE_TWO_PASS
 
-    encoder = ["-map", "0:v:0", "-c:v"]
-    if source_codec == "h264":
-        encoder += ["h264_vaapi", "-b:v:0", bitrate]
-    elif source_codec == "av1":
-        encoder += ["av1_vaapi", "-b:v:0", bitrate]
-    else:
-        # Default to HEVC VAAPI
-        encoder += ["hevc_vaapi", "-b:v:0", bitrate]
+    target_codec = select_encoder(backend, params.get('source_codec'))
+    video_quality = ["-map", "0:v:0", "-c:v", target_codec, "-b:v:0", bitrate,
+                     *spec["encoder_args"].get(target_codec, ()),
+                     "-threads", str(ffmpeg_threads(backend))]
 
-    # Hardware scaling with VAAPI
-    vf = "format=nv12,hwupload"
+    scale = []
     if resolution:
         width, height = resolution
-        vf += f",scale_vaapi=w={width}:h={height}"
+        scale = ["-vf", spec["scale_filter"].format(width=width, height=height)]
+    elif spec["filter"]:
+        scale = ["-vf", spec["filter"]]
+    if scale:
+        scale = ["-filter_threads", str(FFMPEG_FILTER_THREADS)] + scale
 
-    # Construct ffmpeg command line with VAAPI and scaling.
-    cmd = [
-        "ffmpeg", "-y", "-fix_sub_duration",
-        "-hwaccel", "vaapi", "-vaapi_device", AMD_VAAPI_DEVICE,
-        "-i", input_file,
-    ]
+    # Construct the command line.
+    cmd = [*spec["prefix"]]
+    if subs['converted']:
+        # Only converted subtitles are decoded and need their durations fixed
+        cmd += ["-fix_sub_duration"]
+    cmd += ["-i", input_file]
     for sub_input in subs['files']:
         cmd += ["-i", sub_input]
-    cmd += ["-vf", vf, "-map_metadata", "0"]
-    cmd += encoder
-    cmd += ["-map", "0:a", "-c:a", "copy"]
+    cmd += scale
+    cmd += ["-map_metadata", "0"]
+    cmd += video_quality
+    if two_pass:
+        passlog = build_passlog_prefix(output_file)
+        cmd += build_pass_args(target_codec, 2, passlog)
+    cmd += AUDIO_COPY_ARGS
     for sub_map in subs['maps']:
         cmd += sub_map
-    cmd += ["-movflags", "+faststart", output_file]
+    cmd += [*OUTPUT_ARGS, output_file]
 
-    logging.info(f"[CMD] build_ffmpeg_command_amd: {' '.join(cmd)}")
-    return cmd
+    if not two_pass:
+        logging.info(f"[CMD] build_ffmpeg_command ({backend}): {shlex.join(cmd)}")
+        return [cmd]
 
+    # First pass only analyses video for the second one
+    first_pass = [*SOFTWARE_FFMPEG_PREFIX, "-i", input_file] + scale + video_quality
+    first_pass += build_pass_args(target_codec, 1, passlog)
+    first_pass += ["-an", "-sn", "-f", "null", os.devnull]
+    logging.info(
+        f"[CMD] build_ffmpeg_command ({backend}, pass 1): {shlex.join(first_pass)}")
+    logging.info(
+        f"[CMD] build_ffmpeg_command ({backend}, pass 2): {shlex.join(cmd)}")
+    return [first_pass, cmd]
 
-def build_ffmpeg_command_rockchip(input_file, output_file, params):
-    """
-    Rockchip RKMPP: can do h264_rkmpp, hevc_rkmpp.
-    AV1 encoding not supported (decode-only),
-    so fallback to software if AV1 is desired.
-    """
-    bitrate = str(params.get('bitrate'))
-    subs = params.get('subs')
-    resolution = params.get('resolution')
-    source_codec = params.get('source_codec')
-
-    encoder = ["-map", "0:v:0", "-c:v"]
-    if source_codec == "h264":
-        encoder += ["h264_rkmpp", "-b:v:0", bitrate]
-    elif source_codec == "av1":
-        # Rockchip can't encode AV1 => software fallback
-        logging.info(
-            "Rockchip: Falling back to software libaom-av1 for AV1 encoding.")
-        return build_ffmpeg_command_software(
-            input_file, output_file, "libaom-av1", params)
-    else:
-        # Default to HEVC rkmpp
-        encoder += ["hevc_rkmpp", "-b:v:0", bitrate]
-
-    # Construct ffmpeg command line with RKMPP hardware acceleration.
-    cmd = [
-        "ffmpeg", "-y", "-fix_sub_duration",
-        "-hwaccel", "rkmpp",
-        "-i", input_file,
-    ]
-    for sub_input in subs['files']:
-        cmd += ["-i", sub_input]
-    if resolution:
-        width, height = resolution
-        cmd += ["-vf", f"scale={width}:{height}"]
-    cmd += ["-map_metadata", "0"]
-    cmd += encoder
-    cmd += ["-map", "0:a", "-c:a", "copy"]
-    for sub_map in subs['maps']:
-        cmd += sub_map
-    cmd += ["-movflags", "+faststart", output_file]
 
-    logging.info(f"[CMD] build_ffmpeg_command_rockchip: {' '.join(cmd)}")
-    return cmd
+def build_pass_args(target_codec, pass_number, passlog):
+    """Two-pass encoding arguments, libx265 takes them via x265-params."""
+    if target_codec == "libx265":
+        return ["-x265-params", f"pass={pass_number}:stats={passlog}.log"]
+    return ["-pass", str(pass_number), "-passlogfile", passlog]
 
 
-def build_ffmpeg_command_software(input_file, output_file, params):
-    """
-    Fallback software encoding (libx264, libx265, libaom-av1, etc.),
-    preserving metadata/streams if requested.
-    """
-    bitrate = str(params.get('bitrate'))
-    subs = params.get('subs')
-    resolution = params.get('resolution')
-    source_codec = params.get('source_codec')
-
-    # translate source codec to SW codec
-    SOURCE_CODEC_TO_SOFTWARE = {
-        'h264': 'libx264',
-        'hevc': 'libx265',
-        'av1': 'libaom-av1'}
-    target_codec = SOURCE_CODEC_TO_SOFTWARE.get(source_codec, "undef")
-    video_quality = ["-map", "0:v:0", "-c:v", target_codec, "-b:v:0", bitrate]
+def build_passlog_prefix(output_file):
+    """Name of two-pass statistics files for an output file."""
+    digest = hashlib.sha1(output_file.encode()).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"scalyfin_pass_{digest}")
 
-    # Construct the command line.
-    cmd = [
-        "ffmpeg", "-y", "-fix_sub_duration",
-        "-i", input_file,
-    ]
-    for sub_input in subs['files']:
-        cmd += ["-i", sub_input]
-    if resolution:
-        width, height = resolution
-        cmd += ["-vf", f"scale={width}:{height}"]
-    cmd += ["-map_metadata", "0"]
-    cmd += video_quality
-    cmd += ["-map", "0:a", "-c:a", "copy"]
-    for sub_map in subs['maps']:
-        cmd += sub_map
-    cmd += ["-movflags", "+faststart", output_file]
 
-    logging.info(f"[CMD] build_ffmpeg_command_software: {' '.join(cmd)}")
-    return cmd
+def remove_passlog_files(output_file):
+    """Remove two-pass statistics files left by ffmpeg."""
+    for path in glob.glob(build_passlog_prefix(output_file) + "*"):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.debug(f"Error removing file {path}: {e}")
 
 
 # -----------------------------------------------------------
-# INITIAL BULK PROCESS + MAIN (Watchdog + Stability Thread)
+# INITIAL BULK PROCESS + MAIN (inotify + Stability Thread)
 # -----------------------------------------------------------
 
 def process_all_existing_files():
@@ -823,15 +1733,115 @@ def process_all_existing_files():
     Scans the watch directory at startup; queues any video for stability checks
     (unless its 1080p output already exists).
     """
-    for root, dirs, files in os.walk(WATCH_DIR):
-        for f in files:
-            path = os.path.join(root, f)
-            add_file_to_pending(path)
+    # Look outputs up by directory listing, not one stat per file
+    output_names = {}
+    # Non-videos of previous runs stay skipped while unchanged
+    skipped = load_skipped_files()
+    stale_skipped = set(skipped)
+    entries = []
+    for entry in walk_files(WATCH_DIR):
+        if track_skipped_file(entry, skipped.get(entry.path)):
+            stale_skipped.discard(entry.path)
+        elif add_file_to_pending(entry.path, output_names):
+            entries.append(entry)
+    forget_skipped_files(stale_skipped)
+    # Probe tracked files in the background across the probe executor,
+    # so their stability ticks hit the ffprobe cache
+    threading.Thread(target=warm_probes, args=(entries,), daemon=True).start()
+
+
+def track_skipped_file(entry, stamp):
+    """
+    Track a scanned file as skipped if it's unchanged since a previous
+    run found it's not a video. Returns whether it's tracked so.
+    """
+    if stamp is None:
+        return False
+    try:
+        stat = entry.stat()
+    except OSError:
+        return False
+    if stamp != (stat.st_mtime_ns, stat.st_size):
+        return False
+    info = FileInfo()
+    info.inode = stat.st_ino
+    info.mod_time, info.last_size = stamp
+    info.state = FILE_SKIPPABLE
+    with tracked_files_lock:
+        tracked_files.setdefault(entry.path, info)
+    logging.debug(f"File not a video, skipped by previous run: {entry.path}")
+    return True
 
 
-def main():
-    global terminate
+def walk_files(root):
+    """
+    Yield os.DirEntry of video files under root.
+    Walks iteratively with os.scandir, which reads entries via getdents64
+    and takes types from d_type, and filters names by extension
+    before any further per-entry work.
+    Entries cache their stat, so callers stat each file at most once.
+    """
+    dirs = [root]
+    while dirs:
+        dir_path = dirs.pop()
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif has_video_extension(entry.name) and entry.is_file():
+                        yield entry
+        except OSError as e:
+            logging.debug(f"Error scanning directory {dir_path}: {e}")
+
+
+def has_video_extension(name):
+    """Check file name against known video extensions, except temp videos."""
+    return (os.path.splitext(name)[1].lower() in VIDEO_EXTENSIONS
+            and not os.path.basename(name).startswith(TEMP_VIDEO_PREFIX))
+
+
+def is_video_candidate(path):
+    """
+    Cheap pre-filter before spawning mediainfo/ffprobe:
+    extension must be known and size above MIN_VIDEO_SIZE.
+    """
+    if not has_video_extension(path):
+        return False
+    try:
+        return os.stat(path).st_size >= MIN_VIDEO_SIZE
+    except OSError:
+        return False
+
+
+def warm_probes(entries):
+    """
+    Feed startup probes to the probe executor a few at a time,
+    so probes of stable files don't queue behind the whole library.
+    """
+    slots = threading.BoundedSemaphore(PROBE_WORKERS)
+    for entry in entries:
+        slots.acquire()
+        if terminate.is_set():
+            return
+        try:
+            future = probe_executor.submit(warm_probe, entry)
+        except RuntimeError:
+            # Executor shut down
+            return
+        future.add_done_callback(lambda _: slots.release())
+
+
+def warm_probe(entry):
+    """Fill the ffprobe cache for a scanned file, ignoring small files."""
+    try:
+        if entry.stat().st_size >= MIN_VIDEO_SIZE:
+            probe_video(entry.path)
+    except Exception as e:
+        logging.debug(f"Error probing {entry.path}: {e}")
 
+
+def main():
     setup_logging()
 
     # Setup temporary files cleanup on exit
@@ -841,48 +1851,154 @@ def main():
     # docker kill --signal=SIGHUP sends SIGHUP
     signal.signal(signal.SIGHUP, signal_handler)
 
-    # 1) Bulk process existing files
-    process_all_existing_files()
+    # Keep the healthcheck going through slow scans and probes
+    status_thread = threading.Thread(target=update_status_loop, daemon=True)
+    status_thread.start()
 
-    # 2) Start watchdog
-    event_handler = NewcomersHandler()
-    observer = Observer()
-    observer.schedule(event_handler, WATCH_DIR, recursive=True)
-    observer.start()
+    # Load probes of previous runs
+    open_probe_cache()
 
-    # 3) Start stability checker thread
-    checker_thread = threading.Thread(target=stability_checker, daemon=True)
-    checker_thread.start()
+    # 1) Bulk process existing files
+    process_all_existing_files()
 
-    # 4) Start status updater thread
-    status_thread = threading.Thread(target=update_status, daemon=True)
-    status_thread.start()
+    # 2) Start fanotify watcher thread
+    if not WATCH_POLL:
+        closed_files_thread = threading.Thread(
+            target=watch_closed_files, daemon=True)
+        closed_files_thread.start()
 
-    # 5) Start the periodic scanner thread
-    scanner_thread = threading.Thread(target=scan_directory, daemon=True)
-    scanner_thread.start()
+    # 3) Start transcoding workers, each with its own CPU set
+    workers = []
+    for cpus in split_cpus(TRANSCODE_WORKERS):
+        worker = threading.Thread(
+            target=transcode_worker, args=(cpus,), daemon=True)
+        worker.start()
+        workers.append(worker)
 
     logging.info(
         f"Monitoring directory (recursive): {WATCH_DIR}. "
         f"Press Ctrl+C to stop.")
+    # 4) Run inotify, stability checks and scans
     try:
-        while not terminate:
-            time.sleep(1)
+        main_loop()
     except KeyboardInterrupt:
         logging.info("Keyboard interrupt received.")
+    finally:
+        # 5) Stop transcoding workers and their ffmpeg runs,
+        # which are in sessions of their own and would outlive the script
+        stop_workers(workers)
+    # since closed_files_thread is a daemon thread blocked on fanotify
+    # it will automatically terminate when the main program exits
 
-    logging.info("Stopping observer.")
-    observer.stop()
-    observer.join()
-    # since checker_thread and status_thread are daemon threads
-    # they will automatically terminate when the main program exits
 
-
-# Global thread-safe dictionary for pending files
-pending_files = {}
-processed_files = {}
-skippable_files = {}
-pending_files_lock = threading.Lock()
+def stop_workers(workers):
+    """
+    Stop transcoding on shutdown: running ffmpeg processes are terminated,
+    idle workers are woken up, and all of them are joined with a timeout.
+    ffmpeg processes still running after it are killed,
+    before their temporary files are removed.
+    """
+    terminate.set()
+    with ffmpeg_processes_lock:
+        for process in ffmpeg_processes:
+            signal_ffmpeg(process, signal.SIGTERM)
+    for _ in workers:
+        job_queue.put(None)
+    deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+    for worker in workers:
+        worker.join(max(0.0, deadline - time.monotonic()))
+        if worker.is_alive():
+            logging.warning(f"Transcoding worker {worker.name} did not stop")
+    with ffmpeg_processes_lock:
+        for process in ffmpeg_processes:
+            logging.warning(f"Killing ffmpeg process {process.pid}")
+            signal_ffmpeg(process, signal.SIGKILL)
+    check_executor.shutdown(wait=False, cancel_futures=True)
+    probe_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main_loop():
+    """
+    Single event loop of the main thread: waits on the inotify fd
+    and on signals, and runs periodic tasks from monotonic timers
+    until the terminate flag is set.
+    """
+    selector = selectors.DefaultSelector()
+    # Signals wake the loop up through a pipe
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    selector.register(wakeup_read, selectors.EVENT_READ,
+                      functools.partial(os.read, wakeup_read, 512))
+    if WATCH_POLL:
+        logging.info(f"Polling directory every {SCAN_INTERVAL} seconds")
+    else:
+        try:
+            watcher = DirectoryWatcher(WATCH_DIR)
+            selector.register(watcher, selectors.EVENT_READ, watcher.read_events)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"inotify unavailable, relying on periodic scans: {e}")
+
+    # [next run, interval, task]
+    now = time.monotonic()
+    timers = [
+        [now + STABILITY_CHECK_INTERVAL, STABILITY_CHECK_INTERVAL,
+         check_pending_files],
+        [now + SCAN_INTERVAL, SCAN_INTERVAL, scan_directory],
+        [now + RECENT_EVENTS_TTL, RECENT_EVENTS_TTL, prune_recent_events],
+    ]
+    while not terminate.is_set():
+        timeout = max(0.0, min(timer[0] for timer in timers) - time.monotonic())
+        for key, _ in selector.select(timeout):
+            try:
+                key.data()
+            except Exception as e:
+                logging.exception(f"Error handling events: {e}")
+        now = time.monotonic()
+        for timer in timers:
+            if timer[0] <= now and not terminate.is_set():
+                timer[0] = now + timer[1]
+                try:
+                    timer[2]()
+                except Exception as e:
+                    logging.exception(f"Error in {timer[2].__name__}: {e}")
+
+
+# Global thread-safe dictionary of tracked files: path -> FileInfo
+tracked_files = {}
+tracked_files_lock = threading.Lock()
+# Number of tracked files in FILE_PENDING state
+pending_count = 0
+# Last event time per path, touched by the watcher threads
+recent_events = {}
+job_queue = queue.Queue()
+# Outputs of files being processed, see process_file
+busy_outputs = set()
+busy_outputs_cond = threading.Condition()
+# Running ffmpeg processes, terminated on shutdown
+ffmpeg_processes = set()
+# Reentrant, as the signal handler may interrupt stop_workers holding it
+ffmpeg_processes_lock = threading.RLock()
+# Per worker thread state: CPU set of its ffmpeg runs
+worker_state = threading.local()
+gpu_semaphore = threading.Semaphore(GPU_CONCURRENCY)
+cpu_semaphore = threading.Semaphore(CPU_CONCURRENCY)
+# Heap of (next check deadline, path) for pending files
+pending_deadlines = []
+# Executor running stability rounds of due files concurrently
+check_executor = ThreadPoolExecutor(
+    max_workers=CHECK_WORKERS, thread_name_prefix="check")
+# Executor running mediainfo/ffprobe subprocesses concurrently
+probe_executor = ThreadPoolExecutor(
+    max_workers=PROBE_WORKERS, thread_name_prefix="probe")
+# ffprobe results LRU cache: path -> ((mtime_ns, size), stream)
+probe_cache = collections.OrderedDict()
+probe_cache_lock = threading.Lock()
+probe_db = None
+# Released temporary files by suffix, reused by build_temp_path
+temp_pool = {}
+temp_pool_lock = threading.Lock()
 
 if __name__ == "__main__":
     main()